@@ -1,24 +1,20 @@
 import sys
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 import json
+import hashlib
+import base64
+import zlib
+import queue
+import threading
+import time
 import copy
-import requests
 from pathlib import Path
 import argparse
+import os
 
-from fhir.resources.DSTU2.patient import Patient
-from fhir.resources.DSTU2.observation import Observation
-from fhir.resources.DSTU2.codeableconcept import CodeableConcept
-from fhir.resources.DSTU2.coding import Coding
-from fhir.resources.DSTU2.extension import Extension
-from fhir.resources.DSTU2.humanname import HumanName
-from fhir.resources.DSTU2.identifier import Identifier
-from fhir.resources.DSTU2.fhirreference import FHIRReference
-from fhir.resources.DSTU2.fhirdate import FHIRDate
-from fhir.resources.DSTU2.practitioner import Practitioner
-from fhir.resources.DSTU2.organization import Organization
-from fhir.resources.DSTU2.diagnosticreport import DiagnosticReport
-from fhir.resources.DSTU2.period import Period
+## requests and the fhir.resources models are slow to import, so they are
+## imported inside the functions that need them rather than here. This keeps
+## startup cheap for --help, bad arguments and the long-lived serve modes.
 
 SUBJECT_INFO_EXTENSION_URL = "http://commonpass.org/fhir/StructureDefinition/subject-info"
 SUBJECT_INFO_NAME_EXTENSION_URL = "http://commonpass.org/fhir/StructureDefinition/subject-name-info"
@@ -51,7 +47,76 @@ IDENTIFIER_CODE_SYSTEM = "http://hl7.org/fhir/v2/0203"
 IDENTIFIER_PASSPORT_CODE = "PPN"
 IDENTIFIER_USE_OFFICIAL = "official"
 
+UCUM_SYSTEM = "http://unitsofmeasure.org"
+
+SEEDED_GIVEN_NAMES = ["Alex", "Amara", "Chen", "Diego", "Fatima", "Hana", "Ivan", "Kofi", "Lena", "Mateo", "Noor", "Priya", "Sam", "Tomas", "Yuki", "Zara"]
+SEEDED_FAMILY_NAMES = ["Ahmed", "Berg", "Costa", "Dubois", "Garcia", "Ito", "Kowalski", "Mensah", "Nguyen", "Okafor", "Patel", "Rossi", "Silva", "Smith", "Tanaka", "Weber"]
+SEEDED_TIMESTAMP_WINDOW_SECONDS = 30 * 24 * 60 * 60
+SEEDED_ISSUED_DELAY_SECONDS = 48 * 60 * 60
+
+## Seeded generation
+## Every generated value is a pure function of (seed, index, field), so any
+## patient in a dataset can be regenerated on its own without replaying the
+## ones before it, and without touching the global random module.
+def seeded_int(seed, index, field, modulus):
+    digest = hashlib.blake2b(f'{seed}:{index}:{field}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % modulus
+
+## index -> (index * multiplier + offset) mod 10^digits is a bijection when the
+## multiplier is coprime with 10, so distinct indexes never share a number.
+def seeded_unique_number(seed, index, field, digits):
+    modulus = 10 ** digits
+    multiplier = seeded_int(seed, 'multiplier', field, modulus) | 1
+    if multiplier % 5 == 0:
+        multiplier += 2
+    offset = seeded_int(seed, 'offset', field, modulus)
+    return str((index * multiplier + offset) % modulus).zfill(digits)
+
+def generate_passport_number(seed, index, passport_index):
+    number = seeded_unique_number(seed, index, f'passport_{passport_index}', 10)
+    return f'{number[:8]}-{number[8:]}'
+
+def generate_test_identifier(seed, index, result_index):
+    return seeded_unique_number(seed, index, f'test_identifier_{result_index}', 10)
+
+def generate_name(seed, index):
+    given_name = SEEDED_GIVEN_NAMES[seeded_int(seed, index, 'given_name', len(SEEDED_GIVEN_NAMES))]
+    family_name = SEEDED_FAMILY_NAMES[seeded_int(seed, index, 'family_name', len(SEEDED_FAMILY_NAMES))]
+    return given_name, family_name
+
+## Returns copies of the patient, diagnostic report and lab result infos from a
+## config with the patient's name, passport numbers and test identifiers
+## derived from (seed, index). Timestamps and drawn values are filled in by
+## generate_cohort_infos. Passport countries and expirations and codes come
+## from the config.
+def generate_seeded_infos(seed, index, patient_info, diagnostic_report_info, lab_result_infos):
+    given_name, family_name = generate_name(seed, index)
+    passports = []
+    for (passport_index, passport) in enumerate(patient_info['passports']):
+        passport = dict(passport)
+        passport['passport_number'] = generate_passport_number(seed, index, passport_index)
+        passports.append(passport)
+
+    seeded_patient_info = dict(patient_info)
+    seeded_patient_info['given_name'] = given_name
+    seeded_patient_info['family_name'] = family_name
+    seeded_patient_info['passports'] = passports
+
+    seeded_lab_result_infos = []
+    for (result_index, lab_result_info) in enumerate(lab_result_infos):
+        lab_result_info = dict(lab_result_info)
+        lab_result_info['test_identifier'] = generate_test_identifier(seed, index, result_index)
+        seeded_lab_result_infos.append(lab_result_info)
+
+    return seeded_patient_info, dict(diagnostic_report_info), seeded_lab_result_infos
+
 def create_passport_identifier(passport_country, passport_number, passport_expiration_date):
+    from fhir.resources.DSTU2.identifier import Identifier
+    from fhir.resources.DSTU2.fhirreference import FHIRReference
+    from fhir.resources.DSTU2.period import Period
+    from fhir.resources.DSTU2.fhirdate import FHIRDate
+    from fhir.resources.DSTU2.coding import Coding
+    from fhir.resources.DSTU2.codeableconcept import CodeableConcept
 
     identifier = Identifier()
     identifier.value = passport_number
@@ -95,6 +160,7 @@ def get_passport_identifiers(patient):
 #     return None
 
 def create_subject_name_extension(human_name):
+    from fhir.resources.DSTU2.extension import Extension
     extension = Extension()
     extension.url = SUBJECT_INFO_NAME_EXTENSION_URL
     extension.valueHumanName = human_name
@@ -102,6 +168,7 @@ def create_subject_name_extension(human_name):
     return extension
 
 def create_subject_identifier_extension(identifier):
+    from fhir.resources.DSTU2.extension import Extension
     extension = Extension()
     extension.url = SUBJECT_IDENTIFIER_EXTENSION_URL
     extension.valueIdentifier = identifier
@@ -110,6 +177,7 @@ def create_subject_identifier_extension(identifier):
 
 
 def create_subject_info_extension(patient):
+    from fhir.resources.DSTU2.extension import Extension
 
     extension = Extension()
     extension.url = SUBJECT_INFO_EXTENSION_URL
@@ -126,6 +194,8 @@ def create_subject_info_extension(patient):
     return extension
     
 def create_patient(given_name, family_name, passports):
+    from fhir.resources.DSTU2.patient import Patient
+    from fhir.resources.DSTU2.humanname import HumanName
     patient = Patient()
     name = HumanName()
     name.family = [family_name]
@@ -149,6 +219,8 @@ def get_human_readable_name(name):
     return " ".join(name.given + name.family)
 
 def create_codable_concept_with_single_coding(system, code, display, coding_extension):
+    from fhir.resources.DSTU2.coding import Coding
+    from fhir.resources.DSTU2.codeableconcept import CodeableConcept
     coding = Coding()
     coding.system = system
     coding.code = code
@@ -169,7 +241,11 @@ def create_codable_concept_with_single_coding(system, code, display, coding_exte
 # issued time
 # Test manufacturer and test model (and optionally, a unique identifier for the test instance)
 # Testing facility and test administrator
-def create_lab_result_with_contained_patient(patient, test_facility, test_administrator, code_code, code_display, effective_date, issued_date, interpretation, valueString=None, valueQuantity=None, valueCodeableConcept=None):
+def create_lab_result_with_contained_patient(patient, test_facility, test_administrator, code_code, code_display, effective_date, issued_date, interpretation, valueString=None, valueQuantity=None, valueCodeableConcept=None, test_identifier=TEST_IDENTIFIER_EXTENSION_VALUE):
+    from fhir.resources.DSTU2.observation import Observation
+    from fhir.resources.DSTU2.extension import Extension
+    from fhir.resources.DSTU2.fhirreference import FHIRReference
+    from fhir.resources.DSTU2.fhirdate import FHIRDate
     
     contained = []
     
@@ -230,7 +306,7 @@ def create_lab_result_with_contained_patient(patient, test_facility, test_admini
     ##test manufacturer and model (and unique identifier)
     test_id_extension = Extension()
     test_id_extension.url = TEST_IDENTIFIER_EXTENSION_URL
-    test_id_extension.valueString = TEST_IDENTIFIER_EXTENSION_VALUE
+    test_id_extension.valueString = test_identifier
 
     lab_result.method = create_codable_concept_with_single_coding(
         TEST_MANUFACTURER_MODEL_SYSTEM,
@@ -264,7 +340,11 @@ def create_lab_result_with_contained_patient(patient, test_facility, test_admini
 # issued time
 # Test manufacturer and test model (and optionally, a unique identifier for the test instance)
 # Testing facility and test administrator
-def create_lab_result_with_referenced_patient(patient, test_facility, test_administrator, code_code, code_display, effective_date, issued_date, interpretation, valueString=None, valueQuantity=None, valueCodeableConcept=None):
+def create_lab_result_with_referenced_patient(patient, test_facility, test_administrator, code_code, code_display, effective_date, issued_date, interpretation, valueString=None, valueQuantity=None, valueCodeableConcept=None, test_identifier=TEST_IDENTIFIER_EXTENSION_VALUE):
+    from fhir.resources.DSTU2.observation import Observation
+    from fhir.resources.DSTU2.extension import Extension
+    from fhir.resources.DSTU2.fhirreference import FHIRReference
+    from fhir.resources.DSTU2.fhirdate import FHIRDate
     
     contained = []
     
@@ -330,7 +410,7 @@ def create_lab_result_with_referenced_patient(patient, test_facility, test_admin
     ##test manufacturer and model (and unique identifier)
     test_id_extension = Extension()
     test_id_extension.url = TEST_IDENTIFIER_EXTENSION_URL
-    test_id_extension.valueString = TEST_IDENTIFIER_EXTENSION_VALUE
+    test_id_extension.valueString = test_identifier
 
     lab_result.method = create_codable_concept_with_single_coding(
         TEST_MANUFACTURER_MODEL_SYSTEM,
@@ -355,6 +435,7 @@ def create_lab_result_with_referenced_patient(patient, test_facility, test_admin
     return lab_result
 
 def create_lab_organization(organization_id, name):
+    from fhir.resources.DSTU2.organization import Organization
     organization = Organization()
     organization.id = organization_id
     organization.name = name
@@ -362,6 +443,8 @@ def create_lab_organization(organization_id, name):
     return organization
 
 def create_lab_tech(practitioner_id, given_name, family_name):
+    from fhir.resources.DSTU2.practitioner import Practitioner
+    from fhir.resources.DSTU2.humanname import HumanName
     practitioner = Practitioner()
     practitioner.id = practitioner_id
     name = HumanName()
@@ -382,6 +465,9 @@ def create_lab_tech(practitioner_id, given_name, family_name):
 # references to the lab result Observation resources (either contained or standalone resources)
 
 def create_diagnostic_report_with_referenced_observations(patient, test_facility, code_code, code_display, effective_date, issued_date, results):
+    from fhir.resources.DSTU2.diagnosticreport import DiagnosticReport
+    from fhir.resources.DSTU2.fhirreference import FHIRReference
+    from fhir.resources.DSTU2.fhirdate import FHIRDate
 
     contained = []
 
@@ -453,6 +539,9 @@ def create_diagnostic_report_with_referenced_observations(patient, test_facility
     return diagnostic_report
 
 def create_diagnostic_report_with_contained_observations(patient, test_facility, code_code, code_display, effective_date, issued_date, results):
+    from fhir.resources.DSTU2.diagnosticreport import DiagnosticReport
+    from fhir.resources.DSTU2.fhirreference import FHIRReference
+    from fhir.resources.DSTU2.fhirdate import FHIRDate
 
     contained = []
 
@@ -519,53 +608,309 @@ def create_diagnostic_report_with_contained_observations(patient, test_facility,
     diagnostic_report.contained = contained
     return diagnostic_report
 
-def upload_patient(patient, base_url):
-    request_url = f'{base_url}/Patient'
-
-    r = requests.post(
-        request_url,
-        json=patient.as_json()
-    )
-
-    r.raise_for_status()
-
-    return Patient(r.json())
-
-def get_patient(patient_id, base_url):
+## HTTP
+## All requests for a run go through one FHIRClient, which keeps a pooled
+## requests.Session (keep-alive, so TLS handshakes are paid once per
+## connection) and attaches auth headers from an optional auth provider.
+## Auth providers are plain callables that take and return a prepared request,
+## which is what requests expects of session.auth.
+
+class BearerTokenAuth:
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, request):
+        request.headers['Authorization'] = f'Bearer {self.token}'
+        return request
+
+    def invalidate(self):
+        pass
+
+## SMART backend services: a client_credentials grant authenticated with a
+## signed JWT assertion. The access token is cached and refreshed
+## refresh_margin seconds before it expires.
+class SmartBackendServicesAuth:
+    def __init__(self, token_url, client_id, private_key_file_name, scope, key_id=None, algorithm='RS384', refresh_margin=60, timeout=30):
+        self.token_url = token_url
+        self.client_id = client_id
+        self.scope = scope
+        self.key_id = key_id
+        self.algorithm = algorithm
+        self.refresh_margin = refresh_margin
+        self.timeout = timeout
+        with open(private_key_file_name, 'r') as private_key_file:
+            self.private_key = private_key_file.read()
+
+        self.access_token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def create_client_assertion(self):
+        import uuid
+        import jwt
+
+        now = int(time.time())
+        claims = {
+            'iss': self.client_id,
+            'sub': self.client_id,
+            'aud': self.token_url,
+            'exp': now + 300,
+            'jti': str(uuid.uuid4())
+        }
+        headers = {'kid': self.key_id} if self.key_id else None
+        return jwt.encode(claims, self.private_key, algorithm=self.algorithm, headers=headers)
+
+    def fetch_token(self):
+        import requests
+
+        r = requests.post(
+            self.token_url,
+            data={
+                'grant_type': 'client_credentials',
+                'scope': self.scope,
+                'client_assertion_type': 'urn:ietf:params:oauth:client-assertion-type:jwt-bearer',
+                'client_assertion': self.create_client_assertion()
+            },
+            timeout=self.timeout
+        )
 
-    request_url = f'{base_url}/Patient/{patient_id}'
+        r.raise_for_status()
+
+        token_response = r.json()
+        self.access_token = token_response['access_token']
+        self.expires_at = time.monotonic() + token_response.get('expires_in', 300)
+
+    def get_token(self):
+        with self.lock:
+            if self.access_token is None or time.monotonic() >= self.expires_at - self.refresh_margin:
+                self.fetch_token()
+            return self.access_token
+
+    def __call__(self, request):
+        request.headers['Authorization'] = f'Bearer {self.get_token()}'
+        return request
+
+    def invalidate(self):
+        with self.lock:
+            self.access_token = None
+
+def create_auth(auth_info):
+    if auth_info is None:
+        return None
+
+    auth_type = auth_info['type']
+    if auth_type == 'bearer':
+        return BearerTokenAuth(auth_info['token'])
+    elif auth_type == 'smart_backend_services':
+        return SmartBackendServicesAuth(
+            auth_info['token_url'],
+            auth_info['client_id'],
+            auth_info['private_key_file'],
+            auth_info.get('scope', 'system/*.*'),
+            key_id=auth_info.get('key_id'),
+            algorithm=auth_info.get('algorithm', 'RS384'),
+            refresh_margin=auth_info.get('refresh_margin', 60)
+        )
 
-    r = requests.get(
-        request_url
+    raise ValueError(f'Unknown auth type: {auth_type}')
+
+## Adaptive rate control
+## AIMD over both the number of requests in flight and the request start rate.
+## Every `window` completed requests the limiter looks at p95 latency and the
+## share of 429/5xx responses: if both are healthy the limits grow additively,
+## otherwise they are cut multiplicatively. This finds a working level for a
+## fast server without having to hand-tune it for a slow one.
+class AdaptiveRateLimiter:
+    def __init__(self, initial_concurrency=4, min_concurrency=1, max_concurrency=32, initial_rate=20.0, min_rate=1.0, max_rate=500.0, rate_step=5.0, p95_latency_target=2.0, max_error_rate=0.02, window=20, decrease_factor=0.5):
+        self.concurrency_limit = float(initial_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.rate_limit = float(initial_rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.p95_latency_target = p95_latency_target
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.decrease_factor = decrease_factor
+
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.next_start = 0.0
+        self.samples = []
+        self.last_p95_latency = None
+        self.last_error_rate = None
+        self.total_requests = 0
+        self.total_errors = 0
+        self.increases = 0
+        self.decreases = 0
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.concurrency_limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + 1 / self.rate_limit
+
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self, latency, error):
+        with self.condition:
+            self.in_flight -= 1
+            self.total_requests += 1
+            if error:
+                self.total_errors += 1
+            self.samples.append((latency, error))
+            if len(self.samples) >= self.window:
+                self.adjust()
+            self.condition.notify_all()
+
+    def adjust(self):
+        latencies = sorted(latency for (latency, error) in self.samples)
+        self.last_p95_latency = latencies[int(0.95 * (len(latencies) - 1))]
+        self.last_error_rate = sum(1 for (latency, error) in self.samples if error) / len(self.samples)
+        self.samples = []
+
+        if self.last_error_rate > self.max_error_rate or self.last_p95_latency > self.p95_latency_target:
+            self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit * self.decrease_factor)
+            self.rate_limit = max(self.min_rate, self.rate_limit * self.decrease_factor)
+            self.decreases += 1
+        else:
+            self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1)
+            self.rate_limit = min(self.max_rate, self.rate_limit + self.rate_step)
+            self.increases += 1
+
+    def metrics(self):
+        with self.condition:
+            return {
+                'concurrency_limit': int(self.concurrency_limit),
+                'rate_limit': round(self.rate_limit, 2),
+                'p95_latency': self.last_p95_latency,
+                'error_rate': self.last_error_rate,
+                'requests': self.total_requests,
+                'errors': self.total_errors,
+                'increases': self.increases,
+                'decreases': self.decreases
+            }
+
+def create_rate_limiter(rate_control_info):
+    if rate_control_info is None:
+        return None
+
+    return AdaptiveRateLimiter(**rate_control_info)
+
+class FHIRClient:
+    def __init__(self, base_url, auth=None, pool_size=10, timeout=30, limiter=None, max_retries=3):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.base_url = base_url.strip().rstrip('/')
+        self.auth = auth
+        self.timeout = timeout
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.auth = auth
+        self.session.headers['Accept'] = 'application/json+fhir'
+
+    ## Without a limiter requests are sent as-is. With one, every request waits
+    ## for a slot, reports its latency and outcome, and 429/503 responses (which
+    ## the server has not acted on) are retried after Retry-After or a backoff.
+    def send(self, method, url, **kwargs):
+        if self.limiter is None:
+            return self.session.request(method, url, timeout=self.timeout, **kwargs)
+
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            started = time.monotonic()
+            ## any exception (a dropped connection, a truncated body, ...)
+            ## counts as an error and must still give the slot back
+            error = True
+            try:
+                r = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                error = r.status_code == 429 or r.status_code >= 500
+            finally:
+                self.limiter.release(time.monotonic() - started, error)
+
+            if r.status_code not in (429, 503) or attempt == self.max_retries:
+                return r
+
+            retry_after = r.headers.get('Retry-After', '')
+            time.sleep(float(retry_after) if retry_after.isdigit() else 2 ** attempt)
+
+    ## path is either relative to base_url or an absolute URL (e.g. a paging link)
+    def request(self, method, path, **kwargs):
+        url = path if path.startswith('http') else f'{self.base_url}/{path}'
+        r = self.send(method, url, **kwargs)
+
+        ## a token may be revoked before its advertised expiry; refresh once
+        if r.status_code == 401 and self.auth is not None:
+            self.auth.invalidate()
+            r = self.send(method, url, **kwargs)
+
+        r.raise_for_status()
+
+        return r.json()
+
+    def get(self, path, params=None):
+        return self.request('GET', path, params=params)
+
+    def post(self, path, json_body):
+        return self.request('POST', path, json=json_body)
+
+    def close(self):
+        self.session.close()
+
+## Cohort runs keep a pooled connection per upload worker, and with adaptive
+## rate control there are as many workers as the limiter's ceiling.
+def get_pool_size(config):
+    pool_size = config.get('http', {}).get('pool_size', 10)
+    if config.get('patient_count') is not None:
+        pool_size = max(pool_size, config.get('upload_workers', 4))
+        if config.get('rate_control') is not None:
+            pool_size = max(pool_size, config['rate_control'].get('max_concurrency', 32))
+
+    return pool_size
+
+def create_fhir_client(config):
+    base_url = config.get('base_url', config.get('unprotected_base_url'))
+    http_info = config.get('http', {})
+
+    return FHIRClient(
+        base_url,
+        auth=create_auth(config.get('auth')),
+        pool_size=get_pool_size(config),
+        timeout=http_info.get('timeout', 30),
+        limiter=create_rate_limiter(config.get('rate_control'))
     )
 
-    r.raise_for_status()
-
-    return Patient(r.json())
+def upload_patient(patient, client):
+    from fhir.resources.DSTU2.patient import Patient
 
-def upload_diagnostic_report(diagnostic_report, base_url):
-    request_url = f'{base_url}/DiagnosticReport'
+    return Patient(client.post('Patient', patient.as_json()))
 
-    r = requests.post(
-        request_url,
-        json=diagnostic_report.as_json()
-    )
-
-    r.raise_for_status()
+def get_patient(patient_id, client):
+    from fhir.resources.DSTU2.patient import Patient
 
-    return DiagnosticReport(r.json())
+    return Patient(client.get(f'Patient/{patient_id}'))
 
-def upload_observation(observation, base_url):
-    request_url = f'{base_url}/Observation'
+def upload_diagnostic_report(diagnostic_report, client):
+    from fhir.resources.DSTU2.diagnosticreport import DiagnosticReport
 
-    r = requests.post(
-        request_url,
-        json=observation.as_json()
-    )
+    return DiagnosticReport(client.post('DiagnosticReport', diagnostic_report.as_json()))
 
-    r.raise_for_status()
+def upload_observation(observation, client):
+    from fhir.resources.DSTU2.observation import Observation
 
-    return Observation(r.json())
+    return Observation(client.post('Observation', observation.as_json()))
 
 
 # patient = create_patient(
@@ -653,15 +998,43 @@ def write_resource_to_file(resource, filename):
     with open(filename, "w") as outfile: 
         json.dump(resource.as_json(), outfile, indent = 4) 
 
+def write_json_to_file(resource_json, filename):
+    with open(filename, "w") as outfile: 
+        json.dump(resource_json, outfile, indent = 4) 
+
+
+## A lab result info carries exactly one of valueString, valueQuantity
+## ({"value", "unit"}) or valueCodeableConcept ({"system", "code", "display"});
+## this turns it into the matching keyword argument for the lab result builders.
+def create_lab_result_value(lab_result_info):
+    from fhir.resources.DSTU2.quantity import Quantity
+
+    if 'valueQuantity' in lab_result_info:
+        quantity_info = lab_result_info['valueQuantity']
+        quantity = Quantity()
+        quantity.value = quantity_info['value']
+        quantity.unit = quantity_info['unit']
+        quantity.system = UCUM_SYSTEM
+        quantity.code = quantity_info['unit']
+        return {'valueQuantity': quantity}
+
+    if 'valueCodeableConcept' in lab_result_info:
+        coding_info = lab_result_info['valueCodeableConcept']
+        return {'valueCodeableConcept': create_codable_concept_with_single_coding(
+            coding_info['system'],
+            coding_info['code'],
+            coding_info.get('display'),
+            None
+        )}
+
+    return {'valueString': lab_result_info['valueString']}
+
 
 ##Cases
 
 ## 1 - Diagnostic report with contained lab results
 ##lab results MUST reference patient and include patient info in extension
-def create_dr_with_contained_labs(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, base_url, output_directory_name):
-
-    output_dir = f'./{output_directory_name}/dr_with_contained_labs' 
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
+def build_dr_with_contained_labs(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos):
 
     lab_results = []
     for lab_result_info in lab_result_infos:
@@ -674,7 +1047,8 @@ def create_dr_with_contained_labs(uploaded_patient, organization, lab_tech, diag
             datetime.fromisoformat(lab_result_info['effective']).astimezone(),
             datetime.fromisoformat(lab_result_info['issued']).astimezone(),
             lab_result_info['interpretation'],
-            valueString=lab_result_info['valueString']
+            test_identifier=lab_result_info.get('test_identifier', TEST_IDENTIFIER_EXTENSION_VALUE),
+            **create_lab_result_value(lab_result_info)
         )
         lab_results.append(lab_result)
 
@@ -688,6 +1062,21 @@ def create_dr_with_contained_labs(uploaded_patient, organization, lab_tech, diag
         lab_results
     )
 
+    return diagnostic_report, lab_results
+
+def create_dr_with_contained_labs(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, client, output_directory_name):
+
+    output_dir = f'./{output_directory_name}/dr_with_contained_labs' 
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    diagnostic_report, lab_results = build_dr_with_contained_labs(
+        uploaded_patient,
+        organization,
+        lab_tech,
+        diagnostic_report_info,
+        lab_result_infos
+    )
+
     write_resource_to_file(
         diagnostic_report,
         f'{output_dir}/diagnostic_report_pre_upload.json'
@@ -695,7 +1084,7 @@ def create_dr_with_contained_labs(uploaded_patient, organization, lab_tech, diag
 
     uploaded_diagnostic_report = upload_diagnostic_report(
         diagnostic_report,
-        base_url
+        client
     )
 
     write_resource_to_file(
@@ -703,9 +1092,11 @@ def create_dr_with_contained_labs(uploaded_patient, organization, lab_tech, diag
         f'{output_dir}/diagnostic_report.json'
     )
 
+    return uploaded_diagnostic_report, lab_results
+
 
 ## 2 - Diagnostic report with referenced labs, lab results contain patient
-def create_dr_with_referenced_labs_with_contained_patient(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, base_url, output_directory_name):
+def create_dr_with_referenced_labs_with_contained_patient(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, client, output_directory_name):
 
     output_dir = f'./{output_directory_name}/dr_with_referenced_labs_with_contained_patient' 
     Path(output_dir).mkdir(parents=True, exist_ok=True)
@@ -721,7 +1112,8 @@ def create_dr_with_referenced_labs_with_contained_patient(uploaded_patient, orga
             datetime.fromisoformat(lab_result_info['effective']).astimezone(),
             datetime.fromisoformat(lab_result_info['issued']).astimezone(),
             lab_result_info['interpretation'],
-            valueString=lab_result_info['valueString']
+            test_identifier=lab_result_info.get('test_identifier', TEST_IDENTIFIER_EXTENSION_VALUE),
+            **create_lab_result_value(lab_result_info)
         )
 
         write_resource_to_file(
@@ -729,7 +1121,7 @@ def create_dr_with_referenced_labs_with_contained_patient(uploaded_patient, orga
             f'{output_dir}/lab_result_{i}_pre_upload.json'
         )
 
-        uploaded_lab_result = upload_observation(lab_result, base_url)
+        uploaded_lab_result = upload_observation(lab_result, client)
         write_resource_to_file(
             uploaded_lab_result,
             f'{output_dir}/lab_result_{i}.json'
@@ -754,7 +1146,7 @@ def create_dr_with_referenced_labs_with_contained_patient(uploaded_patient, orga
 
     uploaded_diagnostic_report = upload_diagnostic_report(
         diagnostic_report,
-        base_url
+        client
     )
 
     write_resource_to_file(
@@ -762,9 +1154,11 @@ def create_dr_with_referenced_labs_with_contained_patient(uploaded_patient, orga
         f'{output_dir}/diagnostic_report.json'
     )
 
+    return uploaded_diagnostic_report, lab_results
+
 
 ## 3 - Diagnostic report with referenced labs, lab results DO NOT contain patient, and must include patient info extension
-def create_dr_with_referenced_labs_with_referenced_patient(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, base_url, output_directory_name):
+def create_dr_with_referenced_labs_with_referenced_patient(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, client, output_directory_name):
 
     output_dir = f'./{output_directory_name}/dr_with_referenced_labs_with_referenced_patient' 
     Path(output_dir).mkdir(parents=True, exist_ok=True)
@@ -780,7 +1174,8 @@ def create_dr_with_referenced_labs_with_referenced_patient(uploaded_patient, org
             datetime.fromisoformat(lab_result_info['effective']).astimezone(),
             datetime.fromisoformat(lab_result_info['issued']).astimezone(),
             lab_result_info['interpretation'],
-            valueString=lab_result_info['valueString']
+            test_identifier=lab_result_info.get('test_identifier', TEST_IDENTIFIER_EXTENSION_VALUE),
+            **create_lab_result_value(lab_result_info)
         )
 
         write_resource_to_file(
@@ -788,7 +1183,7 @@ def create_dr_with_referenced_labs_with_referenced_patient(uploaded_patient, org
             f'{output_dir}/lab_result_{i}_pre_upload.json'
         )
 
-        uploaded_lab_result = upload_observation(lab_result, base_url)
+        uploaded_lab_result = upload_observation(lab_result, client)
         write_resource_to_file(
             uploaded_lab_result,
             f'{output_dir}/lab_result_{i}.json'
@@ -813,7 +1208,7 @@ def create_dr_with_referenced_labs_with_referenced_patient(uploaded_patient, org
 
     uploaded_diagnostic_report = upload_diagnostic_report(
         diagnostic_report,
-        base_url
+        client
     )
 
     write_resource_to_file(
@@ -821,17 +1216,610 @@ def create_dr_with_referenced_labs_with_referenced_patient(uploaded_patient, org
         f'{output_dir}/diagnostic_report.json'
     )
 
-def main():
+    return uploaded_diagnostic_report, lab_results
+
+## Parquet export
+## Flattens each report into one row per lab result (with its patient,
+## facility and report) and streams the rows into a Parquet file, writing a
+## row group every row_group_size rows so memory stays bounded during a run.
+PARQUET_COLUMNS = [
+    ('patient_id', 'string'),
+    ('given_name', 'string'),
+    ('family_name', 'string'),
+    ('passport_numbers', 'list<string>'),
+    ('passport_countries', 'list<string>'),
+    ('observation_id', 'string'),
+    ('code', 'string'),
+    ('code_display', 'string'),
+    ('value_string', 'string'),
+    ('value_quantity', 'double'),
+    ('value_unit', 'string'),
+    ('value_code', 'string'),
+    ('value_display', 'string'),
+    ('interpretation', 'string'),
+    ('effective', 'timestamp'),
+    ('issued', 'timestamp'),
+    ('test_identifier', 'string'),
+    ('facility_id', 'string'),
+    ('facility_name', 'string'),
+    ('diagnostic_report_id', 'string'),
+    ('diagnostic_report_code', 'string')
+]
+
+def get_parquet_schema():
+    import pyarrow as pa
+
+    types = {
+        'string': pa.string(),
+        'list<string>': pa.list_(pa.string()),
+        'double': pa.float64(),
+        'timestamp': pa.timestamp('us', tz='UTC')
+    }
+    return pa.schema([(name, types[column_type]) for (name, column_type) in PARQUET_COLUMNS])
+
+def get_first_code(codable_concept):
+    if codable_concept is None or not codable_concept.coding:
+        return None, None
+
+    return codable_concept.coding[0].code, codable_concept.coding[0].display
+
+def get_fhir_date(fhir_date):
+    return fhir_date.date if fhir_date is not None else None
+
+def flatten_report(patient, lab_results, diagnostic_report, organization):
+    name = patient.name[0]
+    passport_identifiers = get_passport_identifiers(patient)
+    diagnostic_report_code, _ = get_first_code(diagnostic_report.code)
+
+    rows = []
+    for lab_result in lab_results:
+        code, code_display = get_first_code(lab_result.code)
+        interpretation, _ = get_first_code(lab_result.interpretation)
+        value_code, value_display = get_first_code(lab_result.valueCodeableConcept)
+
+        test_identifier = None
+        if lab_result.method is not None and lab_result.method.coding[0].extension:
+            test_identifier = lab_result.method.coding[0].extension[0].valueString
+
+        rows.append({
+            'patient_id': patient.id,
+            'given_name': " ".join(name.given or []),
+            'family_name': " ".join(name.family or []),
+            'passport_numbers': [identifier.value for identifier in passport_identifiers],
+            'passport_countries': [identifier.assigner.display if identifier.assigner else None for identifier in passport_identifiers],
+            'observation_id': lab_result.id,
+            'code': code,
+            'code_display': code_display,
+            'value_string': lab_result.valueString,
+            'value_quantity': lab_result.valueQuantity.value if lab_result.valueQuantity else None,
+            'value_unit': lab_result.valueQuantity.unit if lab_result.valueQuantity else None,
+            'value_code': value_code,
+            'value_display': value_display,
+            'interpretation': interpretation,
+            'effective': get_fhir_date(lab_result.effectiveDateTime),
+            'issued': get_fhir_date(lab_result.issued),
+            'test_identifier': test_identifier,
+            'facility_id': organization.id,
+            'facility_name': organization.name,
+            'diagnostic_report_id': diagnostic_report.id,
+            'diagnostic_report_code': diagnostic_report_code
+        })
+
+    return rows
+
+class ParquetSink:
+    def __init__(self, file_name, row_group_size=10000):
+        import pyarrow.parquet as pq
+
+        self.schema = get_parquet_schema()
+        self.writer = pq.ParquetWriter(file_name, self.schema)
+        self.row_group_size = row_group_size
+        self.columns = {name: [] for (name, column_type) in PARQUET_COLUMNS}
+        self.row_count = 0
+        self.lock = threading.Lock()
+
+    def add_report(self, patient, lab_results, diagnostic_report, organization):
+        rows = flatten_report(patient, lab_results, diagnostic_report, organization)
+        with self.lock:
+            for row in rows:
+                for (name, value) in row.items():
+                    self.columns[name].append(value)
+            self.row_count += len(rows)
+            if self.row_count >= self.row_group_size:
+                self.flush()
+
+    def flush(self):
+        import pyarrow as pa
+
+        if self.row_count == 0:
+            return
+
+        self.writer.write_table(pa.Table.from_pydict(self.columns, schema=self.schema))
+        self.columns = {name: [] for name in self.columns}
+        self.row_count = 0
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.writer.close()
+
+## Credential packaging
+## Packs a patient and their DiagnosticReport with contained labs into a
+## compact, signed credential: the resources are minified into a collection
+## Bundle with short resource:N references, serialized without whitespace,
+## raw-DEFLATE compressed and signed as a compact JWS (ES256, "zip": "DEF").
+## Signing is CPU bound, so payloads are signed in batches on a process pool
+## whose workers each load the signing key once.
+CREDENTIAL_TYPES = ["https://smarthealth.cards#health-card", "https://smarthealth.cards#laboratory"]
+CREDENTIAL_FHIR_VERSION = "1.0.2"
+CREDENTIAL_PATIENT_REFERENCE = "resource:0"
+CREDENTIAL_DIAGNOSTIC_REPORT_REFERENCE = "resource:1"
+CREDENTIAL_ISSUER_DEFAULT = "urn:commonpass:test-issuer"
+
+def rewrite_references(element, patient_reference, local_ids):
+    if isinstance(element, list):
+        return [rewrite_references(item, patient_reference, local_ids) for item in element]
+    if not isinstance(element, dict):
+        return element
+
+    element = {key: rewrite_references(value, patient_reference, local_ids) for (key, value) in element.items()}
+    reference = element.get('reference')
+    if reference == patient_reference:
+        ## the Patient entry in the bundle carries the name and passports, so
+        ## the subject-info extension and display would only duplicate it
+        return {'reference': CREDENTIAL_PATIENT_REFERENCE}
+    if reference is not None and reference.startswith('#') and reference[1:] in local_ids:
+        element['reference'] = f'#{local_ids[reference[1:]]}'
+
+    return element
+
+## Each contained lab result carries its own copies of the facility and
+## practitioner; they are hoisted into the report's contained list once and
+## every contained resource is renumbered with a short local id.
+def minify_diagnostic_report(patient_json, diagnostic_report_json):
+    diagnostic_report_json = dict(diagnostic_report_json)
 
-    parser = argparse.ArgumentParser(description='Generates sample Patient, DiagnosticReport, and Observation resources')
-    parser.add_argument('config_file', help='Config file')
+    contained = []
+    local_ids = {}
+    def add_contained(resource_json):
+        if resource_json['id'] in local_ids:
+            return
+        local_ids[resource_json['id']] = str(len(contained))
+        contained.append(resource_json)
+
+    for resource_json in diagnostic_report_json.get('contained', []):
+        resource_json = dict(resource_json)
+        for nested_resource_json in resource_json.pop('contained', []):
+            add_contained(nested_resource_json)
+        add_contained(resource_json)
+
+    patient_reference = f"Patient/{patient_json['id']}"
+    minified_contained = []
+    for resource_json in contained:
+        resource_json = rewrite_references(resource_json, patient_reference, local_ids)
+        resource_json['id'] = local_ids[resource_json['id']]
+        minified_contained.append(resource_json)
+
+    diagnostic_report_json.pop('contained', None)
+    diagnostic_report_json = rewrite_references(diagnostic_report_json, patient_reference, local_ids)
+    diagnostic_report_json['contained'] = minified_contained
+    for element in SERVER_MANAGED_ELEMENTS:
+        diagnostic_report_json.pop(element, None)
+
+    patient_json = normalize_resource_json(patient_json)
+
+    return {
+        'resourceType': 'Bundle',
+        'type': 'collection',
+        'entry': [
+            {'fullUrl': CREDENTIAL_PATIENT_REFERENCE, 'resource': patient_json},
+            {'fullUrl': CREDENTIAL_DIAGNOSTIC_REPORT_REFERENCE, 'resource': diagnostic_report_json}
+        ]
+    }
+
+def create_credential_payload(issuer, issued_at, bundle_json):
+    return {
+        'iss': issuer,
+        'nbf': issued_at,
+        'vc': {
+            'type': CREDENTIAL_TYPES,
+            'credentialSubject': {
+                'fhirVersion': CREDENTIAL_FHIR_VERSION,
+                'fhirBundle': bundle_json
+            }
+        }
+    }
+
+## RFC 7638 thumbprint of the public key, used as the JWS kid
+def get_key_id(private_key):
+    import jwt
+
+    public_jwk = json.loads(jwt.algorithms.ECAlgorithm.to_jwk(private_key.public_key()))
+    thumbprint_input = json.dumps({key: public_jwk[key] for key in ['crv', 'kty', 'x', 'y']}, separators=(',', ':'), sort_keys=True)
+    digest = hashlib.sha256(thumbprint_input.encode('utf-8')).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+## Loads the signing key and checks it is an EC P-256 key, as ES256 needs.
+## Called in the parent before a run so a bad key fails fast, and again in
+## each worker from the already-read PEM bytes.
+def load_signing_key(signing_key_pem):
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+    signing_key = load_pem_private_key(signing_key_pem, password=None)
+    if not isinstance(signing_key, ec.EllipticCurvePrivateKey) or signing_key.curve.name != 'secp256r1':
+        raise ValueError('The signing key must be an EC P-256 private key')
+
+    return signing_key
+
+## Set once per signing worker by init_signing_worker
+SIGNING_KEY = None
+SIGNING_KEY_ID = None
+
+def init_signing_worker(signing_key_pem, signing_key_id):
+    global SIGNING_KEY, SIGNING_KEY_ID
+    SIGNING_KEY = load_signing_key(signing_key_pem)
+    SIGNING_KEY_ID = signing_key_id
+
+def sign_credential_batch(batch):
+    from jwt.api_jws import PyJWS
+
+    jws = PyJWS()
+    signed = []
+    for (file_name, payload) in batch:
+        payload_json = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        compressor = zlib.compressobj(level=9, wbits=-15)
+        compressed_payload = compressor.compress(payload_json) + compressor.flush()
+        signed.append((file_name, jws.encode(
+            compressed_payload,
+            SIGNING_KEY,
+            algorithm='ES256',
+            headers={'zip': 'DEF', 'kid': SIGNING_KEY_ID, 'typ': None}
+        )))
+
+    return signed
+
+class CredentialPackager:
+    def __init__(self, signing_key_file_name, issuer, workers=None, batch_size=100):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        with open(signing_key_file_name, 'rb') as signing_key_file:
+            signing_key_pem = signing_key_file.read()
+        signing_key_id = get_key_id(load_signing_key(signing_key_pem))
+
+        self.issuer = issuer
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count()
+        ## spawn rather than fork: the cohort pipeline runs threads, and forking
+        ## a threaded process can copy held locks into the workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_signing_worker,
+            initargs=(signing_key_pem, signing_key_id)
+        )
+        self.batch = []
+        self.futures = {}
+        self.signed_count = 0
+        self.failed_count = 0
+        self.lock = threading.Lock()
+
+    def add(self, file_name, patient, diagnostic_report):
+        bundle_json = minify_diagnostic_report(patient.as_json(), diagnostic_report.as_json())
+        payload = create_credential_payload(self.issuer, int(time.time()), bundle_json)
+        with self.lock:
+            self.batch.append((file_name, payload))
+            if len(self.batch) >= self.batch_size:
+                self.submit_batch()
+
+    ## at most two batches per worker are outstanding, so signing applies
+    ## backpressure to the pipeline instead of queueing without bound
+    def submit_batch(self):
+        from concurrent.futures import wait, FIRST_COMPLETED
+
+        if len(self.batch) == 0:
+            return
+
+        while len(self.futures) >= 2 * self.workers:
+            done, _ = wait(self.futures, return_when=FIRST_COMPLETED)
+            self.collect(done)
+
+        self.futures[self.executor.submit(sign_credential_batch, self.batch)] = len(self.batch)
+        self.batch = []
+
+    ## a batch that failed to sign is counted and reported rather than raised,
+    ## so it neither fails the patient being uploaded nor drops the other
+    ## finished batches
+    def collect(self, done):
+        for future in done:
+            batch_size = self.futures.pop(future)
+            try:
+                signed = future.result()
+            except Exception as e:
+                self.failed_count += batch_size
+                print(f'Signing a batch of {batch_size} credentials failed: {type(e).__name__}: {e}', file=sys.stderr)
+                continue
+
+            for (file_name, credential) in signed:
+                with open(file_name, 'w') as outfile:
+                    outfile.write(credential)
+            self.signed_count += len(signed)
+
+    def close(self):
+        from concurrent.futures import wait
+
+        with self.lock:
+            self.submit_batch()
+            done, _ = wait(self.futures)
+            self.collect(done)
+            self.executor.shutdown()
+
+        return self.signed_count
+
+def package_credential(credential_packager, uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, output_directory_name):
+    diagnostic_report, _ = build_dr_with_contained_labs(
+        uploaded_patient,
+        organization,
+        lab_tech,
+        diagnostic_report_info,
+        lab_result_infos
+    )
 
-    args = parser.parse_args()
-    with open(args.config_file, 'r', newline='') as config_file:
+    credential_packager.add(
+        f'./{output_directory_name}/credential.jws',
+        uploaded_patient,
+        diagnostic_report
+    )
+
+## Verification
+## Reads back everything a run created and compares it with the local
+## *_pre_upload.json outputs. Reports are fetched together with their results
+## by one subject search per batch of patients, and anything left over is
+## fetched with batched _id searches, so each request covers up to
+## SEARCH_BATCH_SIZE patients or resources.
+SEARCH_BATCH_SIZE = 50
+SEARCH_PAGE_SIZE = 100
+SERVER_MANAGED_ELEMENTS = ['id', 'meta', 'text']
+
+def search_all(client, resource_type, params):
+    params = dict(params)
+    params['_count'] = SEARCH_PAGE_SIZE
+    bundle = client.get(resource_type, params=params)
+    while True:
+        for entry in bundle.get('entry', []):
+            yield entry['resource']
+
+        next_links = [link['url'] for link in bundle.get('link', []) if link['relation'] == 'next']
+        if len(next_links) == 0:
+            return
+        bundle = client.get(next_links[0])
+
+def normalize_resource_json(resource_json):
+    return {key: value for (key, value) in resource_json.items() if key not in SERVER_MANAGED_ELEMENTS}
+
+## Every patient's outputs live under the directory holding its
+## patient_pre_upload.json (the output directory itself for a single run,
+## patient_<index> for a cohort run). Walking the tree lazily keeps only the
+## current path in memory.
+def iter_patient_directories(directory):
+    if (directory / 'patient_pre_upload.json').exists():
+        yield directory
+    for child in sorted(path for path in directory.iterdir() if path.is_dir()):
+        yield from iter_patient_directories(child)
+
+## Pre-upload files belonging to one patient directory, without descending
+## into nested patient directories.
+def iter_patient_pre_upload_paths(directory):
+    for path in sorted(directory.iterdir()):
+        if path.is_dir():
+            if not (path / 'patient_pre_upload.json').exists():
+                yield from iter_patient_pre_upload_paths(path)
+        elif path.name.endswith('_pre_upload.json'):
+            yield path
+
+## Each uploaded resource X.json is written next to X_pre_upload.json; the
+## uploaded copy supplies the server id and the pre-upload copy what we sent.
+def load_run_outputs(patient_directories):
+    expected = {}
+    for patient_directory in patient_directories:
+        for pre_upload_path in iter_patient_pre_upload_paths(patient_directory):
+            uploaded_path = pre_upload_path.with_name(pre_upload_path.name.replace('_pre_upload', ''))
+            if not uploaded_path.exists():
+                continue
+
+            with open(uploaded_path, 'r') as uploaded_file:
+                uploaded_json = json.load(uploaded_file)
+            with open(pre_upload_path, 'r') as pre_upload_file:
+                pre_upload_json = json.load(pre_upload_file)
+
+            key = (uploaded_json['resourceType'], uploaded_json['id'])
+            expected[key] = (str(uploaded_path), normalize_resource_json(pre_upload_json))
+
+    return expected
+
+def verify_batch(client, expected, missing, mismatched):
+    found = {}
+
+    patient_references = set()
+    for (resource_type, resource_id), (path, resource_json) in expected.items():
+        if resource_type == 'DiagnosticReport':
+            patient_references.add(resource_json['subject']['reference'])
+
+    if patient_references:
+        for resource_json in search_all(client, 'DiagnosticReport', {
+            'subject': ','.join(sorted(patient_references)),
+            '_include': 'DiagnosticReport:result'
+        }):
+            key = (resource_json['resourceType'], resource_json['id'])
+            if key in expected:
+                found[key] = resource_json
+
+    remaining = {}
+    for (resource_type, resource_id) in expected:
+        if (resource_type, resource_id) not in found:
+            remaining.setdefault(resource_type, []).append(resource_id)
+
+    for resource_type, resource_ids in remaining.items():
+        for i in range(0, len(resource_ids), SEARCH_BATCH_SIZE):
+            batch = resource_ids[i:i + SEARCH_BATCH_SIZE]
+            for resource_json in search_all(client, resource_type, {'_id': ','.join(batch)}):
+                found[(resource_json['resourceType'], resource_json['id'])] = resource_json
+
+    for key, (path, expected_json) in expected.items():
+        if key not in found:
+            missing.append(path)
+            continue
+
+        actual_json = normalize_resource_json(found[key])
+        if actual_json != expected_json:
+            differing_elements = sorted(
+                element for element in set(actual_json) | set(expected_json)
+                if actual_json.get(element) != expected_json.get(element)
+            )
+            mismatched.append((path, differing_elements))
+
+## Patients are verified SEARCH_BATCH_SIZE directories at a time, and each
+## batch's local and server copies are dropped once compared, so memory is
+## bounded by the batch rather than the run.
+def verify_run(client, output_directory_name):
+    checked = 0
+    missing = []
+    mismatched = []
+
+    batch = []
+    for patient_directory in iter_patient_directories(Path(f'./{output_directory_name}')):
+        batch.append(patient_directory)
+        if len(batch) == SEARCH_BATCH_SIZE:
+            expected = load_run_outputs(batch)
+            verify_batch(client, expected, missing, mismatched)
+            checked += len(expected)
+            batch = []
+
+    if batch:
+        expected = load_run_outputs(batch)
+        verify_batch(client, expected, missing, mismatched)
+        checked += len(expected)
+
+    return {
+        'checked': checked,
+        'missing': missing,
+        'mismatched': mismatched
+    }
+
+def print_verification_report(report):
+    print(f"Verified {report['checked']} resources: {len(report['missing'])} missing, {len(report['mismatched'])} mismatched")
+    for path in report['missing']:
+        print(f'  missing: {path}')
+    for (path, differing_elements) in report['mismatched']:
+        print(f"  mismatched: {path} ({', '.join(differing_elements)})")
+
+## Patient index
+## A local SQLite table mapping (base URL, passport number, passport country,
+## name) to the server Patient id, so re-running a config attaches new results
+## to the patient created last time instead of creating a duplicate. It is
+## filled as patients are uploaded, and can be refreshed from the server with
+## batched Patient?identifier= searches.
+class PatientIndex:
+    def __init__(self, file_name):
+        import sqlite3
+
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS patients ('
+                'base_url TEXT NOT NULL, '
+                'passport_number TEXT NOT NULL, '
+                'passport_country TEXT NOT NULL, '
+                'given_name TEXT NOT NULL, '
+                'family_name TEXT NOT NULL, '
+                'patient_id TEXT NOT NULL, '
+                'PRIMARY KEY (base_url, passport_number, passport_country, given_name, family_name))'
+            )
+
+    def lookup(self, base_url, patient):
+        with self.lock:
+            for key in get_patient_index_keys(patient):
+                row = self.connection.execute(
+                    'SELECT patient_id FROM patients WHERE base_url = ? AND passport_number = ? AND passport_country = ? AND given_name = ? AND family_name = ?',
+                    (base_url,) + key
+                ).fetchone()
+                if row is not None:
+                    return row[0]
+
+        return None
+
+    def record(self, base_url, patient):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO patients VALUES (?, ?, ?, ?, ?, ?)',
+                [(base_url,) + key + (patient.id,) for key in get_patient_index_keys(patient)]
+            )
+
+    def close(self):
+        self.connection.close()
+
+## Patients on shared servers may have no name, no identifiers, or passport
+## identifiers without a value; those can't be matched and get no keys. An
+## assigner without a display is recorded with an empty country.
+def get_patient_index_keys(patient):
+    if not patient.name or not patient.identifier:
+        return []
+
+    name = patient.name[0]
+    given_name = " ".join(name.given or [])
+    family_name = " ".join(name.family or [])
+
+    keys = []
+    for passport_identifier in get_passport_identifiers(patient):
+        if not passport_identifier.value:
+            continue
+        passport_country = ''
+        if passport_identifier.assigner is not None and passport_identifier.assigner.display:
+            passport_country = passport_identifier.assigner.display
+        keys.append((passport_identifier.value, passport_country, given_name, family_name))
+
+    return keys
+
+def refresh_patient_index(patient_index, client, passport_numbers):
+    from fhir.resources.DSTU2.patient import Patient
+
+    batch = []
+    for passport_number in passport_numbers:
+        batch.append(passport_number)
+        if len(batch) == SEARCH_BATCH_SIZE:
+            for patient_json in search_all(client, 'Patient', {'identifier': ','.join(batch)}):
+                patient_index.record(client.base_url, Patient(patient_json))
+            batch = []
+
+    if batch:
+        for patient_json in search_all(client, 'Patient', {'identifier': ','.join(batch)}):
+            patient_index.record(client.base_url, Patient(patient_json))
+
+## Returns the server copy of the patient (uploading it if needed) and whether
+## an existing patient was reused.
+def upload_or_reuse_patient(patient, client, patient_index):
+    if patient_index is not None:
+        patient_id = patient_index.lookup(client.base_url, patient)
+        if patient_id is not None:
+            reused_patient = copy.copy(patient)
+            reused_patient.id = patient_id
+            return reused_patient, True
+
+    uploaded_patient = upload_patient(patient, client)
+    if patient_index is not None:
+        patient_index.record(client.base_url, uploaded_patient)
+
+    return uploaded_patient, False
+
+def load_config(config_file_name):
+    with open(config_file_name, 'r', newline='') as config_file:
         config_json_string = config_file.read()
-        config = json.loads(config_json_string)
+        return json.loads(config_json_string)
+
+def run(config, client, patient_index=None, parquet_sink=None, credential_packager=None):
 
-    base_url = config['unprotected_base_url']
     output_directory_name = config['output_directory_name']
     patient_info = config['patient']
     organization_info = config['organization']
@@ -840,7 +1828,18 @@ def main():
     lab_result_infos = config['lab_results']
     Path(f'./{output_directory_name}').mkdir(parents=True, exist_ok=True)
 
-    args = parser.parse_args()
+    ## a seeded single run is the one-patient slice of the cohort at that
+    ## index, so it gets exactly the values a cohort run would give it
+    seed = config.get('seed')
+    if seed is not None:
+        _, patient_info, diagnostic_report_info, lab_result_infos = next(generate_cohort_infos(
+            seed,
+            config.get('patient_index', 0),
+            1,
+            patient_info,
+            diagnostic_report_info,
+            lab_result_infos
+        ))
 
     patient = create_patient(
         patient_info['given_name'], 
@@ -853,7 +1852,14 @@ def main():
         f'./{output_directory_name}/patient_pre_upload.json'
     )
 
-    uploaded_patient = upload_patient(patient, base_url)
+    if patient_index is not None and config.get('refresh_patient_index'):
+        refresh_patient_index(
+            patient_index,
+            client,
+            [passport['passport_number'] for passport in patient_info['passports']]
+        )
+
+    uploaded_patient, _ = upload_or_reuse_patient(patient, client, patient_index)
 
     write_resource_to_file(
         uploaded_patient,
@@ -871,11 +1877,498 @@ def main():
         lab_tech_info["family_name"]
     )
 
-    # create_dr_with_contained_labs(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, base_url, output_directory_name)
-    # create_dr_with_referenced_labs_with_contained_patient(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, base_url, output_directory_name)
-    create_dr_with_referenced_labs_with_referenced_patient(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, base_url, output_directory_name)
+    # create_dr_with_contained_labs(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, client, output_directory_name)
+    # create_dr_with_referenced_labs_with_contained_patient(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, client, output_directory_name)
+    uploaded_diagnostic_report, lab_results = create_dr_with_referenced_labs_with_referenced_patient(uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, client, output_directory_name)
+
+    if parquet_sink is not None:
+        parquet_sink.add_report(uploaded_patient, lab_results, uploaded_diagnostic_report, organization)
+
+    if credential_packager is not None:
+        package_credential(credential_packager, uploaded_patient, organization, lab_tech, diagnostic_report_info, lab_result_infos, output_directory_name)
+
+    return uploaded_patient.id
+
+## Cohort values
+## Seeded runs draw timestamps, result values and interpretations a column at a
+## time with NumPy rather than one value at a time. Columns are drawn for
+## aligned chunks of COHORT_CHUNK_SIZE patients from a generator seeded with
+## (seed, chunk), so any chunk can be regenerated on its own.
+##
+## A lab result in the config may give, instead of a literal valueString:
+##   "quantity_distribution": {"type": "normal" | "lognormal" | "uniform", ...
+##       parameters ..., "unit": "{Ct}", "min": 10, "max": 45, "decimals": 1}
+##   "reference_range": {"low": 40, "high": null}
+##   "interpretations": {"low": "POS", "normal": "NEG", "high": "H"}
+## or
+##   "coded_values": [{"system": ..., "code": ..., "display": ...,
+##       "weight": 0.9, "interpretation": "NEG"}, ...]
+COHORT_CHUNK_SIZE = 1024
+
+def draw_quantity_column(rng, distribution, size):
+    import numpy as np
+
+    distribution_type = distribution.get('type', 'normal')
+    if distribution_type == 'normal':
+        values = rng.normal(distribution['mean'], distribution['sd'], size)
+    elif distribution_type == 'lognormal':
+        values = rng.lognormal(distribution['mean'], distribution['sigma'], size)
+    elif distribution_type == 'uniform':
+        values = rng.uniform(distribution['low'], distribution['high'], size)
+    else:
+        raise ValueError(f'Unknown distribution type: {distribution_type}')
+
+    values = np.clip(values, distribution.get('min', -np.inf), distribution.get('max', np.inf))
+    return np.round(values, distribution.get('decimals', 1))
+
+def derive_interpretation_column(values, reference_range, interpretations):
+    import numpy as np
+
+    low = reference_range.get('low')
+    high = reference_range.get('high')
+    column = np.full(values.shape, interpretations.get('normal', 'N'), dtype=object)
+    if low is not None:
+        column[values < low] = interpretations.get('low', 'L')
+    if high is not None:
+        column[values > high] = interpretations.get('high', 'H')
+
+    return column
+
+def generate_value_columns(seed, chunk_index, lab_result_infos):
+    import numpy as np
+
+    rng = np.random.default_rng([seeded_int(seed, chunk_index, 'value_columns', 2 ** 63)])
+
+    effective_offsets = rng.integers(0, SEEDED_TIMESTAMP_WINDOW_SECONDS, COHORT_CHUNK_SIZE)
+    issued_offsets = effective_offsets + rng.integers(0, SEEDED_ISSUED_DELAY_SECONDS, COHORT_CHUNK_SIZE)
+
+    lab_result_columns = []
+    for lab_result_info in lab_result_infos:
+        if 'quantity_distribution' in lab_result_info:
+            values = draw_quantity_column(rng, lab_result_info['quantity_distribution'], COHORT_CHUNK_SIZE)
+            interpretations = derive_interpretation_column(
+                values,
+                lab_result_info.get('reference_range', {}),
+                lab_result_info.get('interpretations', {})
+            )
+            lab_result_columns.append((values.tolist(), interpretations.tolist()))
+        elif 'coded_values' in lab_result_info:
+            coded_values = lab_result_info['coded_values']
+            weights = np.array([coded_value.get('weight', 1.0) for coded_value in coded_values])
+            choices = rng.choice(len(coded_values), COHORT_CHUNK_SIZE, p=weights / weights.sum())
+            lab_result_columns.append((choices.tolist(), None))
+        else:
+            lab_result_columns.append(None)
+
+    return effective_offsets.tolist(), issued_offsets.tolist(), lab_result_columns
+
+## Yields (index, patient_info, diagnostic_report_info, lab_result_infos) for
+## count patients from first_index on. Identity fields come from
+## generate_seeded_infos; timestamps and values come from the value columns.
+def generate_cohort_infos(seed, first_index, count, patient_info, diagnostic_report_info, lab_result_infos):
+    window_start = datetime.fromisoformat(diagnostic_report_info['effective'])
+    end_index = first_index + count
+
+    chunk_index = first_index // COHORT_CHUNK_SIZE
+    while chunk_index * COHORT_CHUNK_SIZE < end_index:
+        effective_offsets, issued_offsets, lab_result_columns = generate_value_columns(
+            seed,
+            chunk_index,
+            lab_result_infos
+        )
+
+        chunk_start = chunk_index * COHORT_CHUNK_SIZE
+        for index in range(max(first_index, chunk_start), min(chunk_start + COHORT_CHUNK_SIZE, end_index)):
+            row = index - chunk_start
+            seeded_patient_info, seeded_diagnostic_report_info, seeded_lab_result_infos = generate_seeded_infos(
+                seed,
+                index,
+                patient_info,
+                diagnostic_report_info,
+                lab_result_infos
+            )
+
+            effective = (window_start + timedelta(seconds=effective_offsets[row])).isoformat()
+            issued = (window_start + timedelta(seconds=issued_offsets[row])).isoformat()
+            seeded_diagnostic_report_info['effective'] = effective
+            seeded_diagnostic_report_info['issued'] = issued
+
+            for (lab_result_info, columns) in zip(seeded_lab_result_infos, lab_result_columns):
+                lab_result_info['effective'] = effective
+                lab_result_info['issued'] = issued
+                if columns is None:
+                    continue
+
+                values, interpretations = columns
+                if interpretations is not None:
+                    lab_result_info['valueQuantity'] = {
+                        'value': values[row],
+                        'unit': lab_result_info['quantity_distribution']['unit']
+                    }
+                    lab_result_info['interpretation'] = interpretations[row]
+                else:
+                    coded_value = lab_result_info['coded_values'][values[row]]
+                    lab_result_info['valueCodeableConcept'] = coded_value
+                    lab_result_info['interpretation'] = coded_value['interpretation']
+
+            yield index, seeded_patient_info, seeded_diagnostic_report_info, seeded_lab_result_infos
+
+        chunk_index += 1
+
+## Cohort pipeline
+## Generates patient_count seeded patients as a chain of stages connected by
+## bounded queues: generate -> serialize -> write -> upload. A patient holds a
+## slot from the moment it is generated until its report has been uploaded and
+## written, and there are at most max_inflight_patients slots, so memory stays
+## flat however many patients are generated. Lab results and reports reference
+## the server-assigned patient id, so they are built in the upload stage.
+PIPELINE_DONE = object()
+FAILURE_SAMPLE_SIZE = 10
+
+## Counts failed patients and keeps the first few errors, so a run with many
+## failures does not hold one entry per patient.
+class FailureLog:
+    def __init__(self, sample_size=FAILURE_SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.count = 0
+        self.sample = []
+        self.lock = threading.Lock()
+
+    def add(self, index, error):
+        with self.lock:
+            self.count += 1
+            if len(self.sample) < self.sample_size:
+                self.sample.append((index, error))
+
+def run_pipeline_stage(stage, in_queue, out_queue, release_slot, failures):
+    while True:
+        item = in_queue.get()
+        if item is PIPELINE_DONE:
+            in_queue.put(PIPELINE_DONE)
+            return
+
+        try:
+            stage(item)
+        except Exception as e:
+            failures.add(item['index'], f'{type(e).__name__}: {e}')
+            print(f"Patient {item['index']} failed: {type(e).__name__}: {e}", file=sys.stderr)
+            release_slot()
+            continue
+
+        if out_queue is not None:
+            out_queue.put(item)
+
+def run_cohort(config, client, patient_index=None, parquet_sink=None, credential_packager=None):
+    output_directory_name = config['output_directory_name']
+    organization_info = config['organization']
+    lab_tech_info = config['lab_tech']
+    seed = config.get('seed', 0)
+    first_index = config.get('patient_index', 0)
+    patient_count = config['patient_count']
+    max_inflight_patients = config.get('max_inflight_patients', 64)
+    upload_workers = config.get('upload_workers', 4)
+    ## with adaptive rate control the limiter decides how many uploads run at
+    ## once, so there need to be enough workers to reach its ceiling
+    if client.limiter is not None:
+        upload_workers = max(upload_workers, client.limiter.max_concurrency)
+
+    organization = create_lab_organization(
+        organization_info["id"],
+        organization_info["name"]
+    )
+
+    lab_tech = create_lab_tech(
+        lab_tech_info["id"],
+        lab_tech_info["given_name"],
+        lab_tech_info["family_name"]
+    )
+
+    if patient_index is not None and config.get('refresh_patient_index'):
+        refresh_patient_index(
+            patient_index,
+            client,
+            (
+                generate_passport_number(seed, index, passport_index)
+                for index in range(first_index, first_index + patient_count)
+                for passport_index in range(len(config['patient']['passports']))
+            )
+        )
+
+    inflight_slots = threading.BoundedSemaphore(max_inflight_patients)
+    serialize_queue = queue.Queue(maxsize=max_inflight_patients)
+    write_queue = queue.Queue(maxsize=max_inflight_patients)
+    upload_queue = queue.Queue(maxsize=max_inflight_patients)
+    failures = FailureLog()
+    completed = {'patients': 0, 'reused': 0}
+    completed_lock = threading.Lock()
+
+    def serialize(item):
+        item['patient_json'] = item['patient'].as_json()
+
+    def write(item):
+        Path(item['output_directory_name']).mkdir(parents=True, exist_ok=True)
+        write_json_to_file(
+            item['patient_json'],
+            f"./{item['output_directory_name']}/patient_pre_upload.json"
+        )
+
+    def upload(item):
+        uploaded_patient, reused = upload_or_reuse_patient(item['patient'], client, patient_index)
+
+        write_resource_to_file(
+            uploaded_patient,
+            f"./{item['output_directory_name']}/patient.json"
+        )
+
+        uploaded_diagnostic_report, lab_results = create_dr_with_referenced_labs_with_referenced_patient(uploaded_patient, organization, lab_tech, item['diagnostic_report_info'], item['lab_result_infos'], client, item['output_directory_name'])
+
+        if parquet_sink is not None:
+            parquet_sink.add_report(uploaded_patient, lab_results, uploaded_diagnostic_report, organization)
+
+        if credential_packager is not None:
+            package_credential(credential_packager, uploaded_patient, organization, lab_tech, item['diagnostic_report_info'], item['lab_result_infos'], item['output_directory_name'])
+
+        with completed_lock:
+            completed['patients'] += 1
+            if reused:
+                completed['reused'] += 1
+        inflight_slots.release()
+
+    stages = [
+        (serialize, serialize_queue, write_queue, 1),
+        (write, write_queue, upload_queue, 1),
+        (upload, upload_queue, None, upload_workers)
+    ]
+    threads = []
+    for (stage, in_queue, out_queue, worker_count) in stages:
+        stage_threads = [
+            threading.Thread(target=run_pipeline_stage, args=(stage, in_queue, out_queue, inflight_slots.release, failures), daemon=True)
+            for _ in range(worker_count)
+        ]
+        for thread in stage_threads:
+            thread.start()
+        threads.append(stage_threads)
+
+    for (index, patient_info, diagnostic_report_info, lab_result_infos) in generate_cohort_infos(
+        seed,
+        first_index,
+        patient_count,
+        config['patient'],
+        config['diagnostic_report'],
+        config['lab_results']
+    ):
+        inflight_slots.acquire()
+
+        serialize_queue.put({
+            'index': index,
+            'output_directory_name': f'{output_directory_name}/patient_{index}',
+            'patient': create_patient(
+                patient_info['given_name'],
+                patient_info['family_name'],
+                patient_info['passports']
+            ),
+            'diagnostic_report_info': diagnostic_report_info,
+            'lab_result_infos': lab_result_infos
+        })
+
+    ## shut the stages down in order so each drains before the next stops
+    for ((stage, in_queue, out_queue, worker_count), stage_threads) in zip(stages, threads):
+        in_queue.put(PIPELINE_DONE)
+        for thread in stage_threads:
+            thread.join()
+
+    result = {
+        'patients': completed['patients'],
+        'reused_patients': completed['reused'],
+        'failed': failures.count
+    }
+    if failures.sample:
+        result['failure_sample'] = failures.sample
+
+    return result
+
+## Patient indexes are cached by file name so serve-mode jobs share one connection.
+PATIENT_INDEXES = {}
+
+def get_patient_index(config):
+    file_name = config.get('patient_index_file')
+    if file_name is None:
+        return None
+    if file_name not in PATIENT_INDEXES:
+        PATIENT_INDEXES[file_name] = PatientIndex(file_name)
+
+    return PATIENT_INDEXES[file_name]
+
+def run_config(config, client):
+    patient_index = get_patient_index(config)
+
+    parquet_sink = None
+    if config.get('parquet_file') is not None:
+        parquet_sink = ParquetSink(config['parquet_file'], config.get('parquet_row_group_size', 10000))
+
+    credential_packager = None
+    if config.get('signing_key_file') is not None:
+        credential_packager = CredentialPackager(
+            config['signing_key_file'],
+            config.get('credential_issuer', CREDENTIAL_ISSUER_DEFAULT),
+            workers=config.get('signing_workers'),
+            batch_size=config.get('signing_batch_size', 100)
+        )
+
+    try:
+        if config.get('patient_count') is not None:
+            result = run_cohort(config, client, patient_index, parquet_sink, credential_packager)
+        else:
+            result = {'patient_id': run(config, client, patient_index, parquet_sink, credential_packager)}
+    finally:
+        if parquet_sink is not None:
+            parquet_sink.close()
+        if credential_packager is not None:
+            signed_credentials = credential_packager.close()
+
+    if credential_packager is not None:
+        result['signed_credentials'] = signed_credentials
+        if credential_packager.failed_count:
+            result['failed_credentials'] = credential_packager.failed_count
+    if client.limiter is not None:
+        result['rate_control'] = client.limiter.metrics()
+
+    return result
+
+## Long-lived mode
+## Each job is a single line: either a path to a config file or an inline JSON
+## config. One result line is written back per job, so a caller can pipeline
+## many configs through one process and only pay the import cost once.
+## Clients are cached by their connection settings so that jobs against the
+## same server reuse pooled connections and cached tokens.
+FHIR_CLIENTS = {}
+
+def get_fhir_client(config):
+    client_key = json.dumps([
+        config.get('base_url', config.get('unprotected_base_url')),
+        config.get('auth'),
+        config.get('http'),
+        config.get('rate_control'),
+        get_pool_size(config)
+    ], sort_keys=True)
+    if client_key not in FHIR_CLIENTS:
+        FHIR_CLIENTS[client_key] = create_fhir_client(config)
+
+    return FHIR_CLIENTS[client_key]
+
+def run_job(line):
+    line = line.strip()
+    try:
+        if line.startswith('{'):
+            config = json.loads(line)
+        else:
+            config = load_config(line)
+        result = run_config(config, get_fhir_client(config))
+    except Exception as e:
+        return json.dumps({'job': line, 'error': f'{type(e).__name__}: {e}'})
+
+    return json.dumps({'job': line, **result})
+
+def serve_stdin():
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        print(run_job(line), flush=True)
+
+def serve_socket(socket_path):
+    import socketserver
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                line = line.decode('utf-8')
+                if not line.strip():
+                    continue
+                self.wfile.write((run_job(line) + '\n').encode('utf-8'))
+                self.wfile.flush()
+
+    Path(socket_path).unlink(missing_ok=True)
+    with socketserver.UnixStreamServer(socket_path, JobHandler) as server:
+        print(f'Listening for jobs on {socket_path}', flush=True)
+        try:
+            server.serve_forever()
+        finally:
+            Path(socket_path).unlink(missing_ok=True)
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Generates sample Patient, DiagnosticReport, and Observation resources')
+    parser.add_argument('config_file', nargs='?', help='Config file')
+    parser.add_argument('--seed', help='Generate patient names, passport numbers, test identifiers and timestamps from this seed (overrides "seed" in the config)')
+    parser.add_argument('--patient-index', type=int, help='Index of the seeded patient to generate (overrides "patient_index" in the config)')
+    parser.add_argument('--count', type=int, help='Generate this many seeded patients, starting at --patient-index, through the bounded pipeline (overrides "patient_count" in the config)')
+    parser.add_argument('--max-inflight-patients', type=int, help='Maximum number of patients held in the pipeline at once (default 64)')
+    parser.add_argument('--upload-workers', type=int, help='Number of patients uploaded concurrently (default 4)')
+    parser.add_argument('--adaptive-rate', action='store_true', help='Adapt upload concurrency and request rate to observed latency and errors (tuned by "rate_control" in the config)')
+    parser.add_argument('--patient-index-file', metavar='PATH', help='SQLite file mapping passports and names to existing server patients, which are reused instead of created again (overrides "patient_index_file" in the config)')
+    parser.add_argument('--refresh-patient-index', action='store_true', help='Before generating, fill the patient index from the server with batched Patient?identifier= searches')
+    parser.add_argument('--parquet', metavar='PATH', help='Also write one row per uploaded lab result, with its patient, facility and report, to this Parquet file (overrides "parquet_file" in the config)')
+    parser.add_argument('--signing-key', metavar='PATH', help='Also package each patient and report into a signed credential.jws using this PEM EC P-256 private key (overrides "signing_key_file" in the config)')
+    parser.add_argument('--verify', action='store_true', help='After generating, read back everything in the output directory and compare it with the pre-upload files')
+    parser.add_argument('--verify-only', action='store_true', help='Only verify an existing output directory; do not generate anything')
+    parser.add_argument('--serve-stdin', action='store_true', help='Read one job (config file path or inline JSON config) per line from stdin')
+    parser.add_argument('--serve-socket', metavar='PATH', help='Accept jobs, one per line, on a Unix domain socket')
+
+    args = parser.parse_args()
 
-    print(f'Created resources for patient ID: {uploaded_patient.id}')
+    if args.serve_stdin:
+        serve_stdin()
+        return
+
+    if args.serve_socket:
+        serve_socket(args.serve_socket)
+        return
+
+    if args.config_file is None:
+        parser.error('a config file is required unless --serve-stdin or --serve-socket is used')
+
+    config = load_config(args.config_file)
+    if args.seed is not None:
+        config['seed'] = args.seed
+    if args.patient_index is not None:
+        config['patient_index'] = args.patient_index
+    if args.count is not None:
+        config['patient_count'] = args.count
+    if args.max_inflight_patients is not None:
+        config['max_inflight_patients'] = args.max_inflight_patients
+    if args.upload_workers is not None:
+        config['upload_workers'] = args.upload_workers
+    if args.patient_index_file is not None:
+        config['patient_index_file'] = args.patient_index_file
+    if args.refresh_patient_index:
+        config['refresh_patient_index'] = True
+    if args.parquet is not None:
+        config['parquet_file'] = args.parquet
+    if args.signing_key is not None:
+        config['signing_key_file'] = args.signing_key
+    if args.adaptive_rate and config.get('rate_control') is None:
+        config['rate_control'] = {}
+
+    client = create_fhir_client(config)
+    try:
+        if not args.verify_only:
+            result = run_config(config, client)
+            if 'patient_id' in result:
+                print(f"Created resources for patient ID: {result['patient_id']}")
+            else:
+                print(f"Created resources for {result['patients']} patients ({result['reused_patients']} existing patients reused, {result['failed']} failed)")
+            if 'signed_credentials' in result:
+                print(f"Signed {result['signed_credentials']} credentials ({result.get('failed_credentials', 0)} failed)")
+            if 'rate_control' in result:
+                print(f"Rate control: {json.dumps(result['rate_control'])}")
+
+        if args.verify or args.verify_only:
+            report = verify_run(client, config['output_directory_name'])
+            print_verification_report(report)
+            if report['missing'] or report['mismatched']:
+                sys.exit(1)
+    finally:
+        client.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,16 @@
+## Tracks CLI startup cost. --help exercises argument parsing only, so any
+## heavy module (requests, fhir.resources) showing up here is a regression.
+## The second run imports everything a real job needs, for comparison.
+OUTPUT_DIRECTORY=./benchmark_output
+mkdir -p $OUTPUT_DIRECTORY
+
+python -X importtime DSTU2.py --help > /dev/null 2> $OUTPUT_DIRECTORY/importtime_help.txt
+## everything a single job imports: requests plus the DSTU2 models it builds
+python -X importtime -c "import DSTU2, requests; from fhir.resources.DSTU2 import patient, observation, diagnosticreport, organization, practitioner, quantity, codeableconcept, coding, extension, humanname, identifier, fhirreference, fhirdate, period" 2> $OUTPUT_DIRECTORY/importtime_full.txt
+
+for FILE in $OUTPUT_DIRECTORY/importtime_help.txt $OUTPUT_DIRECTORY/importtime_full.txt; do
+    echo "$FILE"
+    echo "  modules imported: $(grep -c 'import time:' $FILE)"
+    echo "  total self (us):  $(awk -F'|' '/import time:/ { gsub(/[^0-9]/, "", $1); sum += $1 } END { print sum }' $FILE)"
+    grep -E '\| +(requests|fhir\.resources)$' $FILE
+done